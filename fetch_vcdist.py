@@ -5,7 +5,8 @@ with a new different version of the runtime. This script aims to maintain
 a copy of the various versions.
 
 Versions are normally added once I encounter them, in November 2022, I added
-a rather large back catalogue of versions.
+a rather large back catalogue of versions. The versions and where to download
+them from are listed in runtimes.json.
 
 This requires dark.exe from Wix (http://wixtoolset.org/releases/) and
 expand.exe (File Expansion Utility - this comes with Microsoft Windows).
@@ -21,242 +22,430 @@ Known Limitations:
 from __future__ import print_function
 
 import argparse
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import json
 import os
-import requests
+import posixpath
+import re
+import shutil
 import subprocess
 import tempfile
-import zipfile
+import threading
+
+from urllib.parse import urlparse
+
+
+# The number of downloads to run at once. This is kept low to avoid being
+# throttled by the CDN.
+DOWNLOAD_WORKERS = 8
+
+# The size of the blocks read from the network and written to disk.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Files at least this large are downloaded as several byte ranges at once, as
+# a single connection to the CDN often can't make full use of the link.
+RANGE_DOWNLOAD_THRESHOLD = 8 << 20
+RANGE_DOWNLOAD_PARTS = 4
+# The size of each range, which is also how much of the file an interrupted
+# download can lose.
+RANGE_DOWNLOAD_PIECE_SIZE = 4 << 20
+
+# The number of expand.exe processes to run at once.
+EXTRACT_WORKERS = 8
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _session(download_workers=DOWNLOAD_WORKERS):
+    """Returns the session shared by all downloads.
+
+    This means connections to each host are kept alive and reused rather than
+    a new TLS handshake being done per file. requests is only imported once
+    something needs to be downloaded.
+
+    download_workers: The number of downloads run at once, which the
+                      connection pool is sized for. Only the first call
+                      creates the session, so only its value is used.
+    """
+    global _SESSION
+    # The download workers all make their first request at once, so this is
+    # locked to ensure they end up sharing one session.
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            _SESSION = requests.Session()
+            for scheme in ('http://', 'https://'):
+                _SESSION.mount(scheme, HTTPAdapter(
+                    pool_connections=download_workers,
+                    pool_maxsize=download_workers * RANGE_DOWNLOAD_PARTS))
+        return _SESSION
+
+
+# Most of the downloads from Microsoft include the SHA-256 of the file as one
+# of the components of the path.
+_SHA256_IN_URI = re.compile(r'/([0-9A-Fa-f]{64})/')
+
+
+def _sha256_of_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _cache_path(download_directory, uri):
+    """Returns where the file at uri is kept in the download cache.
+
+    The cache is keyed by the SHA-256 of the uri, as many of the runtimes share
+    the same file name.
+    """
+    key = hashlib.sha256(uri.encode('utf-8')).hexdigest()
+    return os.path.join(download_directory, 'cache', key[:2], key)
+
+
+_CACHE_LOCKS = {}
+_CACHE_LOCKS_LOCK = threading.Lock()
+
+
+def _cache_lock(path):
+    """Returns the lock guarding a file in the download cache.
+
+    Several runtimes are downloaded from the same uri, so this prevents two
+    workers writing to the same file at once.
+    """
+    with _CACHE_LOCKS_LOCK:
+        return _CACHE_LOCKS.setdefault(path, threading.Lock())
+
+
+def _link_or_copy(source, dest):
+    try:
+        os.link(source, dest)
+    except OSError:
+        # Hard links aren't supported by the file system.
+        shutil.copyfile(source, dest)
+
+
+# On Windows, O_SEQUENTIAL opens the file with FILE_FLAG_SEQUENTIAL_SCAN which
+# has the cache manager retire the pages of the file quickly, as each part of
+# it is only written once.
+_SEQUENTIAL_WRITE_FLAGS = (os.O_WRONLY | os.O_CREAT |
+                           getattr(os, 'O_BINARY', 0) |
+                           getattr(os, 'O_SEQUENTIAL', 0))
+
+
+def _open_sequential(path, flags=0):
+    """Opens path for a download to be written to it.
+
+    flags: Additional os.O_* flags to open the file with.
+    """
+    return os.fdopen(os.open(path, _SEQUENTIAL_WRITE_FLAGS | flags), 'wb',
+                     buffering=DOWNLOAD_CHUNK_SIZE)
+
+
+def _download_range(uri, dest, start, end, validator):
+    """Download bytes start to end (inclusive) of the uri into dest.
+
+    validator: The validator the file had when the download was started, if
+               the server gave one.
+    """
+    headers = {'Range': 'bytes=%d-%d' % (start, end)}
+    if validator:
+        headers['If-Range'] = validator
+    with _session().get(uri, stream=True, headers=headers) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            # This is also the response when the file has changed since the
+            # download was started.
+            raise ValueError('The server ignored the range requested from ' +
+                             uri + '.')
+        r.raw.decode_content = True
+        with _open_sequential(dest) as f:
+            f.seek(start)
+            shutil.copyfileobj(r.raw, f, DOWNLOAD_CHUNK_SIZE)
+
+
+def _download_ranges(uri, dest, size, validator):
+    """Download the uri to dest as several byte ranges at once.
+
+    The file is written as dest.part and only renamed to dest once every range
+    has been downloaded, so an interrupted download isn't mistaken for a
+    complete one. When the server gave a validator for the file, the ranges
+    completed so far are recorded in dest.part.json so an interrupted download
+    can be resumed. Otherwise dest.part is removed if the download fails.
+
+    validator: The validator of the file from the server, if any.
+    """
+    partial = dest + '.part'
+    progress_path = partial + '.json'
+
+    progress = None
+    if validator and os.path.isfile(partial) and os.path.isfile(progress_path):
+        with open(progress_path) as f:
+            progress = json.load(f)
+        if progress.get('size') != size or \
+                progress.get('validator') != validator:
+            # The file has changed since the download was started.
+            progress = None
+
+    if progress is None:
+        progress = {'size': size, 'validator': validator, 'done': []}
+        with open(partial, 'wb') as f:
+            f.truncate(size)
+
+    done = set(tuple(byte_range) for byte_range in progress['done'])
+    ranges = [(start, min(start + RANGE_DOWNLOAD_PIECE_SIZE, size) - 1)
+              for start in range(0, size, RANGE_DOWNLOAD_PIECE_SIZE)]
+    progress_lock = threading.Lock()
+
+    def download(byte_range):
+        _download_range(uri, partial, byte_range[0], byte_range[1], validator)
+        if not validator:
+            return
+        with progress_lock:
+            progress['done'].append(byte_range)
+            with open(progress_path + '.tmp', 'w') as f:
+                json.dump(progress, f)
+            os.replace(progress_path + '.tmp', progress_path)
+
+    completed = False
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=RANGE_DOWNLOAD_PARTS) as executor:
+            list(executor.map(
+                download,
+                [byte_range for byte_range in ranges
+                 if byte_range not in done]))
+        completed = True
+    finally:
+        if not completed and not validator:
+            # Without a validator the download can't be safely resumed.
+            os.remove(partial)
+
+    os.replace(partial, dest)
+    if os.path.isfile(progress_path):
+        os.remove(progress_path)
+
+
+def _validator(response):
+    """Returns the validator of the response to use with If-Range, if any.
+
+    A weak ETag can't be used with If-Range.
+    """
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def _download_to(uri, dest):
+    """Download the uri to dest.
+
+    If dest is shorter than the file on the server, such as when a prior run
+    was interrupted, the rest of the file is downloaded and appended to it as
+    long as the server can confirm the file hasn't changed. Otherwise it is
+    downloaded again. When the uri contains the SHA-256 of the file the result
+    is verified.
+    """
+    import requests
+
+    expected_size = -1
+    accept_ranges = None
+    head_validator = None
+    try:
+        head = _session().head(uri, allow_redirects=True)
+    except requests.RequestException:
+        # Without the server, a file already downloaded is used as it is.
+        head = None
+    if head is not None and head.ok:
+        # An error response's length is that of the error page, not the file.
+        expected_size = int(head.headers.get('Content-Length', -1))
+        accept_ranges = head.headers.get('Accept-Ranges')
+        head_validator = _validator(head)
+
+    # The validator of the file being downloaded is kept alongside it until
+    # the download completes, so an interrupted download can be resumed.
+    validator_path = dest + '.validator'
+
+    headers = {}
+    if os.path.isfile(dest):
+        size = os.path.getsize(dest)
+        if expected_size < 0 or size == expected_size:
+            # Skipping, already downloaded.
+            return dest
+
+        validator = None
+        if os.path.isfile(validator_path):
+            with open(validator_path) as f:
+                validator = f.read()
+
+        if size < expected_size and validator:
+            # If-Range has the server send the whole file rather than the rest
+            # of it if the file has changed since dest was started.
+            headers['Range'] = 'bytes=%d-' % size
+            headers['If-Range'] = validator
+        else:
+            # The file can't be shown to be the one on the server, so start
+            # over.
+            os.remove(dest)
+
+    if (not headers and expected_size >= RANGE_DOWNLOAD_THRESHOLD and
+            accept_ranges == 'bytes'):
+        _download_ranges(uri, dest, expected_size, head_validator)
+    else:
+        r = _session().get(uri, stream=True, headers=headers)
+        r.raise_for_status()
+        # Have urllib3 undo any Content-Encoding as iter_content() would have.
+        r.raw.decode_content = True
+        # The server may ignore the range and send the whole file instead.
+        if r.status_code == 206:
+            flags = os.O_APPEND
+        else:
+            flags = os.O_TRUNC
+            validator = _validator(r)
+            if validator:
+                with open(validator_path, 'w') as f:
+                    f.write(validator)
+            elif os.path.isfile(validator_path):
+                os.remove(validator_path)
+        with _open_sequential(dest, flags) as f:
+            shutil.copyfileobj(r.raw, f, DOWNLOAD_CHUNK_SIZE)
+        if os.path.isfile(validator_path):
+            os.remove(validator_path)
+
+    match = _SHA256_IN_URI.search(uri)
+    if match and _sha256_of_file(dest) != match.group(1).lower():
+        os.remove(dest)
+        raise ValueError('The file downloaded from ' + uri +
+                         ' does not match its SHA-256.')
+    return dest
 
 
 def download_file(uri, dest):
-    """Download the uri to dest."""
+    """Download the uri to dest.
+
+    The file is downloaded into the cache directory next to dest and dest is
+    then linked (or copied) from the cache.
+    """
+    cached = _cache_path(os.path.dirname(dest), uri)
+    with _cache_lock(cached):
+        if not os.path.isdir(os.path.dirname(cached)):
+            os.makedirs(os.path.dirname(cached))
+
+        if not os.path.isfile(cached) and os.path.isfile(dest):
+            # Adopt the file downloaded before there was a cache.
+            _link_or_copy(dest, cached)
+
+        _download_to(uri, cached)
+
     if os.path.isfile(dest):
-        # Skipping, already downloaded.
-        return dest
-    r = requests.get(uri, stream=True)
-    with open(dest, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk: # filter out keep-alive new chunks
-                f.write(chunk)
+        if (os.path.samefile(cached, dest) or
+                os.path.getsize(cached) == os.path.getsize(dest)):
+            return dest
+        os.remove(dest)
+
+    _link_or_copy(cached, dest)
     return dest
 
-def fetch_runtimes(download_directory, include_old_versions):
-    """Fetches the Visual C++ x64 Redistributable from Microsoft.
 
-    download_directory: The directory to write the resulting files in.
-    include_old_versions: If true versions older than 14 will be fetched.
+def _update_cache_index(download_directory, paths):
+    """Records the cached file of each version in the cache's index.json.
 
-    Return the (version, runtime_file) for each known runtime.
+    paths: A dictionary of version to the path of its file in the cache.
     """
-    # Some of these packages came from:
-    # https://blogs.technet.microsoft.com/jagbal/2017/09/04/where-can-i-download-the-old-visual-c-redistributables/
-    # Others came from Chocolatey (https://chocolatey.org/)
-    runtime_downloads = [
-        (
-            '14.42.34438.0',
-            'https://download.visualstudio.microsoft.com/download/pr/285b28c7-3cf9-47fb-9be8-01cf5323a8df/8F9FB1B3CFE6E5092CF1225ECD6659DAB7CE50B8BF935CB79BFEDE1F3C895240/VC_redist.x64.exe'
-        )
-        (
-            '6.0.2900.2180',  # Visual C++ 6.
-            'https://download.microsoft.com/download/8/B/4/8B42259F-5D70-43F4-AC2E-4B208FD8D66A/vcredist_x64.EXE',
-        ),
-        (
-            '8.0.50727.619501',  # Visual C++ 2005.
-            'https://download.microsoft.com/download/8/B/4/8B42259F-5D70-43F4-AC2E-4B208FD8D66A/vcredist_x64.EXE',
-        ),
-        (
-            '9.0.30729.4148',  # Visual C++ 2008.
-            'https://download.microsoft.com/download/9/7/7/977B481A-7BA6-4E30-AC40-ED51EB2028F2/vcredist_x64.exe',
-        ),
-        (
-            '10.0.40219.32503', # Visual C++ 2010.
-            'https://download.microsoft.com/download/1/6/5/165255E7-1014-4D0A-B094-B6A430A6BFFC/vcredist_x64.exe',
-        ),
-        (
-            '11.0.61030.0', # Visual C++ 2012.
-            'http://download.microsoft.com/download/1/6/B/16B06F60-3B20-4FF2-B699-5E9B7962F9AE/VSU_4/vcredist_x64.exe',
-        ),
-        (
-            '12.0.30501.0', # Visual C++ 2013.
-            'http://download.microsoft.com/download/2/E/6/2E61CFA4-993B-4DD4-91DA-3737CD5CD6E3/vcredist_x64.exe',
-        ),
-        # Visual C++ 2015 to 2022.
-        (
-            '14.0.23026.0',
-            'https://download.microsoft.com/download/9/3/F/93FCF1E7-E6A4-478B-96E7-D4B285925B00/vc_redist.x64.exe',
-            # This next one seems to be the same version.
-            #'https://download.microsoft.com/download/4/7/a/47a9d485-9e3a-4707-be1d-26011ff15f42/vc_redist.x64.exe',
-        ),
-        (
-            '14.0.25325.0',
-            'https://download.visualstudio.microsoft.com/download/pr/11100230/15ccb3f02745c7b206ad10373cbca89b/VC_redist.x64.exe',
-        ),
-        (
-            '14.10.25017',
-            'https://download.microsoft.com/download/3/b/f/3bf6e759-c555-4595-8973-86b7b4312927/vc_redist.x64.exe',
-        ),
-        (
-            '14.10.25008.0',
-            'https://download.microsoft.com/download/8/9/d/89d195e1-1901-4036-9a75-fbe46443fc5a/vc_redist.x64.exe',
-        ),
-        (
-            '14.10.25017.0',
-            'https://download.microsoft.com/download/3/b/f/3bf6e759-c555-4595-8973-86b7b4312927/vc_redist.x64.exe',
-        ),
-        (
-            '14.11.25325.0',
-            'https://download.visualstudio.microsoft.com/download/pr/11100230/15ccb3f02745c7b206ad10373cbca89b/VC_redist.x64.exe',
-        ),
-        (
-            '14.12.25810',
-            'https://download.visualstudio.microsoft.com/download/pr/100349091/2cd2dba5748dc95950a5c42c2d2d78e4/VC_redist.x64.exe',
-        ),
-        (
-            '14.12.2581',
-            'https://download.visualstudio.microsoft.com/download/pr/100349091/2cd2dba5748dc95950a5c42c2d2d78e4/VC_redist.x64.exe',
-        ),
-        (
-            '14.15.26706',
-            'https://download.visualstudio.microsoft.com/download/pr/20ef12bb-5283-41d7-90f7-eb3bb7355de7/8b58fd89f948b2430811db3da92299a6/vc_redist.x64.exe',
-        ),
-        (
-            '14.16.27012',
-            'https://download.visualstudio.microsoft.com/download/pr/9fbed7c7-7012-4cc0-a0a3-a541f51981b5/e7eec15278b4473e26d7e32cef53a34c/vc_redist.x64.exe',
-        ),
-        (
-            '14.16.27024',
-            'https://download.visualstudio.microsoft.com/download/pr/46db022e-06ea-4d11-a724-d26d33bc63f7/2b635c854654745078d5577a8ed0f80d/vc_redist.x64.exe',
-        ),
-        (
-            '14.16.27027',
-            'https://download.visualstudio.microsoft.com/download/pr/36c5faaf-bd8b-433f-b3d7-2af73bae10a8/212f41f2ccffee6d6dc27f901b7d77a1/vc_redist.x64.exe',
-        ),
-        (
-            '14.16.27033',
-            'https://download.visualstudio.microsoft.com/download/pr/4100b84d-1b4d-487d-9f89-1354a7138c8f/5B0CBB977F2F5253B1EBE5C9D30EDBDA35DBD68FB70DE7AF5FAAC6423DB575B5/VC_redist.x64.exe',
-        ),
-        (
-            '14.20.27508',
-            'https://download.visualstudio.microsoft.com/download/pr/21614507-28c5-47e3-973f-85e7f66545a4/f3a2caa13afd59dd0e57ea374dbe8855/vc_redist.x64.exe',
-        ),
-        (
-            '14.21.27702',
-            'https://download.visualstudio.microsoft.com/download/pr/9e04d214-5a9d-4515-9960-3d71398d98c3/1e1e62ab57bbb4bf5199e8ce88f040be/vc_redist.x64.exe',
-        ),
-        (
-            '14.22.27821',
-            'https://download.visualstudio.microsoft.com/download/pr/cc0046d4-e7b4-45a1-bd46-b1c079191224/9c4042a4c2e6d1f661f4c58cf4d129e9/vc_redist.x64.exe',
-        ),
-        (
-            '14.23.27820',
-            'https://download.visualstudio.microsoft.com/download/pr/9565895b-35a6-434b-a881-11a6f4beec76/EE84FED2552E018E854D4CD2496DF4DD516F30733A27901167B8A9882119E57C/VC_redist.x64.exe',
-        ),
-        (
-            '14.24.28127',
-            'https://download.visualstudio.microsoft.com/download/pr/3b070396-b7fb-4eee-aa8b-102a23c3e4f4/40EA2955391C9EAE3E35619C4C24B5AAF3D17AEAA6D09424EE9672AA9372AEED/VC_redist.x64.exe',
-        ),
-        (
-            '14.25.28508',
-            'https://download.visualstudio.microsoft.com/download/pr/8c211be1-c537-4402-82e7-a8fb5ee05e8a/B6C82087A2C443DB859FDBEAAE7F46244D06C3F2A7F71C35E50358066253DE52/VC_redist.x64.exe',
-        ),
-        (
-            '14.26.28720',
-            'https://download.visualstudio.microsoft.com/download/pr/d60aa805-26e9-47df-b4e3-cd6fcc392333/7D7105C52FCD6766BEEE1AE162AA81E278686122C1E44890712326634D0B055E/VC_redist.x64.exe',
-        ),
-        (
-            '14.27.29112',
-            'https://download.visualstudio.microsoft.com/download/pr/48431a06-59c5-4b63-a102-20b66a521863/4B5890EB1AEFDF8DFA3234B5032147EB90F050C5758A80901B201AE969780107/VC_redist.x64.exe',
-        ),
-        (
-            '14.28.29325',
-            'https://download.visualstudio.microsoft.com/download/pr/89a3b9df-4a09-492e-8474-8f92c115c51d/B1A32C71A6B7D5978904FB223763263EA5A7EB23B2C44A0D60E90D234AD99178/VC_redist.x64.exe',
-        ),
-        (
-            '14.28.29910',
-            'https://download.visualstudio.microsoft.com/download/pr/cd3a705f-70b6-46f7-b8e2-63e6acc5bd05/F299953673DE262FEFAD9DD19BFBE6A5725A03AE733BEBFEC856F1306F79C9F7/VC_redist.x64.exe',
-        ),
-        (
-            '14.28.29913',
-            'https://download.visualstudio.microsoft.com/download/pr/366c0fb9-fe05-4b58-949a-5bc36e50e370/015EDD4E5D36E053B23A01ADB77A2B12444D3FB6ECCEFE23E3A8CD6388616A16/VC_redist.x64.exe',
-        ),
-        (
-            '14.28.29914',
-            'https://download.visualstudio.microsoft.com/download/pr/85d47aa9-69ae-4162-8300-e6b7e4bf3cf3/52B196BBE9016488C735E7B41805B651261FFA5D7AA86EB6A1D0095BE83687B2/VC_redist.x64.exe',
-        ),
-        (
-            '14.29.30037',
-            'https://download.visualstudio.microsoft.com/download/pr/f1998402-3cc0-466f-bd67-d9fb6cd2379b/A1592D3DA2B27230C087A3B069409C1E82C2664B0D4C3B511701624702B2E2A3/VC_redist.x64.exe',
-        ),
-        (
-            '14.29.30040',
-            'https://download.visualstudio.microsoft.com/download/pr/36e45907-8554-4390-ba70-9f6306924167/97CC5066EB3C7246CF89B735AE0F5A5304A7EE33DC087D65D9DFF3A1A73FE803/VC_redist.x64.exe',
-        ),
-        (
-            '14.29.30133',
-            'https://download.visualstudio.microsoft.com/download/pr/7239cdc3-bd73-4f27-9943-22de059a6267/003063723B2131DA23F40E2063FB79867BAE275F7B5C099DBD1792E25845872B/VC_redist.x64.exe',
-        ),
-        (
-            '14.29.30135',
-            'https://download.visualstudio.microsoft.com/download/pr/d3cbdace-2bb8-4dc5-a326-2c1c0f1ad5ae/9B9DD72C27AB1DB081DE56BB7B73BEE9A00F60D14ED8E6FDE45DAB3E619B5F04/VC_redist.x64.exe',
-        ),
-        (
-            '14.29.30139',
-            'https://download.visualstudio.microsoft.com/download/pr/b929b7fe-5c89-4553-9abe-6324631dcc3a/296F96CD102250636BCD23AB6E6CF70935337B1BBB3507FE8521D8D9CFAA932F/VC_redist.x64.exe',
-        ),
-        (
-            '14.30.30704',
-            'https://download.visualstudio.microsoft.com/download/pr/10a8d53a-c69e-4586-8c6b-c416bf85a0ae/A9F5D2EAF67BF0DB0178B6552A71C523C707DF0E2CC66C06BFBC08BDC53387E7/VC_redist.x64.exe',
-        ),
-        (
-            '14.30.30708',
-            'https://download.visualstudio.microsoft.com/download/pr/571ad766-28d1-4028-9063-0fa32401e78f/5D3D8C6779750F92F3726C70E92F0F8BF92D3AE2ABD43BA28C6306466DE8A144/VC_redist.x64.exe',
-        ),
-        (
-            '14.31.31103',
-            'https://download.visualstudio.microsoft.com/download/pr/d22ecb93-6eab-4ce1-89f3-97a816c55f04/37ED59A66699C0E5A7EBEEF7352D7C1C2ED5EDE7212950A1B0A8EE289AF4A95B/VC_redist.x64.exe',
-        ),
-        (
-            '14.32.31326',
-            'https://download.visualstudio.microsoft.com/download/pr/6b6923b0-3045-4379-a96f-ef5506a65d5b/426A34C6F10EA8F7DA58A8C976B586AD84DD4BAB42A0CFDBE941F1763B7755E5/VC_redist.x64.exe',
-        ),
-        (
-            '14.32.31332',
-            'https://download.visualstudio.microsoft.com/download/pr/ed95ef9e-da02-4735-9064-bd1f7f69b6ed/CE6593A1520591E7DEA2B93FD03116E3FC3B3821A0525322B0A430FAA6B3C0B4/VC_redist.x64.exe',
-        ),
-        (
-            '14.34.31931',
-            'https://download.visualstudio.microsoft.com/download/pr/bcb0cef1-f8cb-4311-8a5c-650a5b694eab/2257B3FBE3C7559DE8B31170155A433FAF5B83829E67C589D5674FF086B868B9/VC_redist.x64.exe',
-        ),
-        (
-            '14.34.31938',
-            'https://download.visualstudio.microsoft.com/download/pr/8b92f460-7e03-4c75-a139-e264a770758d/26C2C72FBA6438F5E29AF8EBC4826A1E424581B3C446F8C735361F1DB7BEFF72/VC_redist.x64.exe',
-        ),
-        (
-            '14.36.32532',
-            'https://download.visualstudio.microsoft.com/download/pr/eaab1f82-787d-4fd7-8c73-f782341a0c63/917C37D816488545B70AFFD77D6E486E4DD27E2ECE63F6BBAAF486B178B2B888/VC_redist.x64.exe',
-        ),
-        (
-            '14.38.33130',
-            'https://download.visualstudio.microsoft.com/download/pr/a061be25-c14a-489a-8c7c-bb72adfb3cab/4DFE83C91124CD542F4222FE2C396CABEAC617BB6F59BDCBDF89FD6F0DF0A32F/VC_redist.x64.exe',
-        ),
-        (
-            '14.38.33135',
-            'https://download.visualstudio.microsoft.com/download/pr/6ba404bb-6312-403e-83be-04b062914c98/1AD7988C17663CC742B01BEF1A6DF2ED1741173009579AD50A94434E54F56073/VC_redist.x64.exe'
-        ),
-        (
-            '14.40.33810',
-            'https://download.visualstudio.microsoft.com/download/pr/1754ea58-11a6-44ab-a262-696e194ce543/3642E3F95D50CC193E4B5A0B0FFBF7FE2C08801517758B4C8AEB7105A091208A/VC_redist.x64.exe'
-        ),
-    ]
-
-    for version, download_uri in runtime_downloads:
-        if not include_old_versions and int(version.partition('.')[0]) < 14:
+    if not paths:
+        return
+
+    cache_directory = os.path.join(download_directory, 'cache')
+    index_path = os.path.join(cache_directory, 'index.json')
+    index = {}
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    index.update(
+        (version, os.path.relpath(path, cache_directory))
+        for version, path in paths.items())
+
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+
+# The downloads for each version of the runtime. Where the packages came from
+# is listed under "sources".
+_RUNTIMES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'runtimes.json')
+
+Runtime = collections.namedtuple('Runtime', 'version major uri')
+
+
+@functools.lru_cache(maxsize=None)
+def _runtimes():
+    """Returns the Runtime for each entry in runtimes.json."""
+    with open(_RUNTIMES_PATH) as f:
+        entries = json.load(f)['runtimes']
+    return tuple(
+        Runtime(entry['version'], int(entry['version'].partition('.')[0]),
+                entry['uri'])
+        for entry in entries)
+
+
+@functools.lru_cache(maxsize=None)
+def _dests():
+    """Returns the name of the file each runtime's installer is saved as."""
+    return {
+        runtime.version: runtime.version + '_' + posixpath.basename(
+            urlparse(runtime.uri).path)
+        for runtime in _runtimes()
+    }
+
+
+def _planned_downloads(download_directory, include_old_versions):
+    """Returns the (runtime, destination) for each runtime to fetch.
+
+    download_directory: The directory to write the resulting files in.
+    include_old_versions: If true versions older than 14 will be included.
+    """
+    plan = []
+    for runtime in _runtimes():
+        if not include_old_versions and runtime.major < 14:
             # Don't include versions older than version 14.
             continue
 
-        filename = version + '_' + os.path.basename(download_uri)
-        destination = download_file(download_uri, os.path.join(download_directory, filename))
-        yield version, destination
+        destination = os.path.join(download_directory,
+                                   _dests()[runtime.version])
+        plan.append((runtime, destination))
+    return plan
+
+
+def fetch_runtimes(download_directory, plan, executor):
+    """Fetches the Visual C++ x64 Redistributable from Microsoft.
+
+    download_directory: The directory to write the resulting files in.
+    plan: The (runtime, destination) for each runtime to fetch, as returned by
+          _planned_downloads().
+    executor: The executor the downloads are run on.
+
+    Yields the (runtime, runtime_file) for each runtime as its download
+    completes.
+    """
+    futures = {
+        executor.submit(download_file, runtime.uri, destination): runtime
+        for runtime, destination in plan
+    }
+    for future in concurrent.futures.as_completed(futures):
+        yield futures[future], future.result()
+
+    _update_cache_index(download_directory, dict(
+        (runtime.version, _cache_path(download_directory, runtime.uri))
+        for runtime, _ in plan))
 
 
 def fetch_7zip(download_directory):
@@ -269,13 +458,12 @@ def fetch_7zip(download_directory):
     # Next, it downloads a 7z and extracts that which contains a more fully
     # fledged console executable that can extract the CAB files in the old
     # executables.
-    exe_path = os.path.join(download_directory, '__7zr.exe')
-    if not os.path.isfile(exe_path):
-        download_file('https://7-zip.org/a/7zr.exe', exe_path)
+    exe_path = download_file('https://7-zip.org/a/7zr.exe',
+                             os.path.join(download_directory, '__7zr.exe'))
 
-    tool_archive = os.path.join(download_directory, '7z2301-extra.7z')
-    if not os.path.isfile(tool_archive):
-        download_file('https://7-zip.org/a/7z2301-extra.7z', tool_archive)
+    tool_archive = download_file(
+        'https://7-zip.org/a/7z2301-extra.7z',
+        os.path.join(download_directory, '7z2301-extra.7z'))
 
     # Extract the 7z file.
     tools_path = os.path.join(download_directory, '_7z')
@@ -285,22 +473,36 @@ def fetch_7zip(download_directory):
     return os.path.join(tools_path, '7za.exe')
 
 
-def extract_old_installer(seven_zip_exe, self_extracting_archive):
-    """Extracts the older self-extracting archives.
+def extract_old_installer_to(seven_zip_exe, self_extracting_archive,
+                             output_directory):
+    """Extracts the older self-extracting archives to output_directory.
+
+    The cabinet files are extracted to a directory within output_directory and
+    expanded from there, rather than going through a temporary directory
+    elsewhere. That directory is removed afterwards, even if expanding fails.
 
     seven_zip_exe: The path to 7-zip console executable.
     self_extracting_archive: The executable to extract.
     """
-    output_directory = tempfile.mkdtemp()
-    subprocess.call(
-        [seven_zip_exe, "x", '-o' + output_directory, self_extracting_archive,
-         '-i!*.cab'])
+    cab_directory = os.path.join(output_directory, '__cabs')
+    try:
+        subprocess.call(
+            [seven_zip_exe, "x", '-o' + cab_directory, self_extracting_archive,
+             '-i!*.cab'])
 
-    if not os.listdir(output_directory):
-        raise ValueError('Failed to extract any cabinet file from ' +
-                         self_extracting_archive + '.')
+        cabs = []
+        if os.path.isdir(cab_directory):
+            with os.scandir(cab_directory) as entries:
+                cabs = [entry.path for entry in entries
+                        if entry.is_file() and
+                        entry.name.lower().endswith('.cab')]
+        if not cabs:
+            raise ValueError('Failed to extract any cabinet file from ' +
+                             self_extracting_archive + '.')
 
-    return output_directory
+        extract_cabs(cabs, output_directory)
+    finally:
+        shutil.rmtree(cab_directory, ignore_errors=True)
 
 
 def fetch_wix(download_directory):
@@ -308,16 +510,24 @@ def fetch_wix(download_directory):
 
     This is used to extract the runtime packages.
     """
-    zip_path = os.path.join(download_directory, '__wix.zip')
-    if not os.path.isfile(zip_path):
-        wix = 'https://github.com/wixtoolset/wix3/releases/download/' + \
-            'wix3111rtm/wix311-binaries.zip'
-        download_file(wix, zip_path)
-
-    with zipfile.ZipFile(zip_path, 'r') as zip_file:
-        zip_file.extractall(os.path.join(download_directory, '__wix'))
-
-    return os.path.join(download_directory, '__wix')
+    wix = 'https://github.com/wixtoolset/wix3/releases/download/' + \
+        'wix3111rtm/wix311-binaries.zip'
+    zip_path = download_file(wix,
+                             os.path.join(download_directory, '__wix.zip'))
+
+    wix_directory = os.path.join(download_directory, '__wix')
+    if not os.path.isdir(wix_directory):
+        # The binaries are extracted to a separate directory that is only
+        # renamed to __wix once it is complete, so an interrupted extraction
+        # isn't mistaken for a complete one.
+        import zipfile
+        partial_directory = wix_directory + '.partial'
+        shutil.rmtree(partial_directory, ignore_errors=True)
+        with zipfile.ZipFile(zip_path, 'r') as zip_file:
+            zip_file.extractall(partial_directory)
+        os.replace(partial_directory, wix_directory)
+
+    return wix_directory
 
 
 def extract_burn_bundle(wix_tool_location, bundle_exe):
@@ -333,54 +543,162 @@ def extract_burn_bundle(wix_tool_location, bundle_exe):
 
 def find_cabs(directory):
     base_path = os.path.join(directory, 'AttachedContainer', 'packages')
-    for name in os.listdir(base_path):
-        if name.endswith('_amd64'):
-            yield os.path.join(base_path, name, 'cab1.cab')
+    with os.scandir(base_path) as entries:
+        for entry in entries:
+            if entry.is_dir() and entry.name.endswith('_amd64'):
+                yield os.path.join(entry.path, 'cab1.cab')
 
 
 def extract_cab(cab_source, destination):
-    subprocess.call(['expand.exe', "-F:*", cab_source, destination])
+    # The per-file progress expand.exe writes to stdout isn't needed.
+    subprocess.run(['expand.exe', "-F:*", cab_source, destination],
+                   check=True, stdout=subprocess.DEVNULL)
 
 
-def fetch_all(base_directory, include_old_versions):
-    download_directory = os.path.join(base_directory, 'Downloads')
+def extract_cabs(cab_sources, destination):
+    """Extracts each of the CAB files to destination.
 
-    if not os.path.isdir(download_directory):
-        raise SystemError('The download directory does not exist: %s' %
-                          download_directory)
+    The CABs in a package contain different files, so they are extracted in
+    parallel.
+    """
+    cab_sources = list(cab_sources)
+    if not cab_sources:
+        return
 
-    wix_tool_location = fetch_wix(download_directory)
-    for ver, installer in fetch_runtimes(download_directory,
-                                         include_old_versions):
-        output_directory = os.path.join(base_directory, 'vcruntime_' + ver)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(EXTRACT_WORKERS, len(cab_sources))) as executor:
+        list(executor.map(lambda cab: extract_cab(cab, destination),
+                          cab_sources))
 
-        if not os.path.isdir(output_directory):
-            os.makedirs(output_directory)
 
-        major_version = int(ver.partition('.')[0])
+def _output_directory(base_directory, runtime):
+    return os.path.join(base_directory, 'vcruntime_' + runtime.version)
 
-        if os.listdir(output_directory):
-            print('Already have ' + ver)
-            continue
 
-        if major_version == 10:
-            # The CAB is located located .\.\.\.\vc_red.cab which
-            # extract_old_installer() can't cope with.
-            print('Cannot extract Visual C++ 2010 runtime. Skipping.')
-            continue
+def _has_output(base_directory, runtime):
+    """Returns True if the runtime has already been extracted.
 
-        if  major_version < 11:
-            # Older versions of the do not use WiX and do not contain a
-            # .wixburn data section.
-            cab_directory = extract_old_installer(
-                fetch_7zip(download_directory), installer)
-            for cab in os.listdir(cab_directory):
-                extract_cab(os.path.join(cab_directory, cab), output_directory)
+    A vcruntime_<version>.partial directory left by an interrupted extraction
+    doesn't count, and is replaced when the runtime is next extracted.
+    """
+    output_directory = _output_directory(base_directory, runtime)
+    if not os.path.isdir(output_directory):
+        return False
+    with os.scandir(output_directory) as entries:
+        return any(entries)
 
-            continue
 
-        for cab in find_cabs(extract_burn_bundle(wix_tool_location, installer)):
-            extract_cab(cab, output_directory)
+def extract_runtime(base_directory, runtime, installer, wix_tool_location,
+                    seven_zip_exe):
+    """Extracts a runtime installer to the vcruntime_<version> directory.
+
+    wix_tool_location: The directory containing dark.exe, this is only needed
+                       for version 11 onwards.
+    seven_zip_exe: The path to 7-zip console executable, this is only needed
+                   for versions prior to 11.
+    """
+    # The runtime is extracted to a separate directory that is only renamed to
+    # vcruntime_<version> once it is complete, so a partially extracted runtime
+    # isn't mistaken for an extracted one, even if this process is killed.
+    output_directory = _output_directory(base_directory, runtime)
+    partial_directory = output_directory + '.partial'
+    shutil.rmtree(partial_directory, ignore_errors=True)
+    os.makedirs(partial_directory)
+
+    if  runtime.major < 11:
+        # Older versions of the do not use WiX and do not contain a
+        # .wixburn data section.
+        extract_old_installer_to(seven_zip_exe, installer, partial_directory)
+    else:
+        bundle_directory = extract_burn_bundle(wix_tool_location, installer)
+        try:
+            extract_cabs(find_cabs(bundle_directory), partial_directory)
+        finally:
+            shutil.rmtree(bundle_directory, ignore_errors=True)
+
+    # An empty directory may have been left by an earlier version of this
+    # script.
+    if os.path.isdir(output_directory):
+        os.rmdir(output_directory)
+    os.replace(partial_directory, output_directory)
+
+
+def fetch_all(base_directory, include_old_versions,
+              download_workers=DOWNLOAD_WORKERS):
+    download_directory = os.path.join(base_directory, 'Downloads')
+
+    if not os.path.isdir(download_directory):
+        raise SystemError('The download directory does not exist: %s' %
+                          download_directory)
+
+    # Runtimes that have already been extracted, or can't be, are skipped
+    # before anything is downloaded.
+    plan = []
+    for runtime, destination in _planned_downloads(download_directory,
+                                                   include_old_versions):
+        if runtime.major == 10:
+            # The CAB is located located .\.\.\.\vc_red.cab which
+            # extract_old_installer_to() can't cope with.
+            print('Cannot extract Visual C++ 2010 runtime. Skipping.')
+        elif _has_output(base_directory, runtime):
+            print('Already have ' + runtime.version)
+        else:
+            plan.append((runtime, destination))
+
+    # Version 11 onwards are extracted with WiX and those before it with 7-zip.
+    need_wix = any(runtime.major >= 11 for runtime, _ in plan)
+    need_7zip = any(runtime.major < 11 for runtime, _ in plan)
+
+    if plan:
+        # Size the connection pool for the number of workers.
+        _session(download_workers)
+
+    # Each installer is handed over for extraction as soon as its download
+    # completes, so extracting overlaps with the remaining downloads. The
+    # installers are extracted one at a time as extract_cabs() already runs
+    # the CABs within an installer in parallel.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=download_workers) as executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as extractor:
+        # The tools are downloaded alongside the runtimes.
+        wix_future = None
+        if need_wix:
+            wix_future = executor.submit(fetch_wix, download_directory)
+        seven_zip_future = None
+        if need_7zip:
+            seven_zip_future = executor.submit(fetch_7zip, download_directory)
+
+        def extract(runtime, installer):
+            # Only wait for the tool this runtime is extracted with.
+            wix_tool_location = None
+            seven_zip_exe = None
+            if runtime.major >= 11:
+                wix_tool_location = wix_future.result()
+            else:
+                seven_zip_exe = seven_zip_future.result()
+            extract_runtime(base_directory, runtime, installer,
+                            wix_tool_location, seven_zip_exe)
+
+        extractions = [
+            extractor.submit(extract, runtime, installer)
+            for runtime, installer in fetch_runtimes(
+                download_directory, plan, executor)
+        ]
+
+        for extraction in extractions:
+            extraction.result()
+
+
+def _positive_int(value):
+    """Parses a command line argument that must be a number of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid int value: %r' % value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1: %s' % value)
+    return number
+
 
 # import os
 # import zipfile
@@ -410,6 +728,12 @@ if __name__ == '__main__':
         action='store_true',
         help='Include older versions of the runtime prior to version 14. The '
              'first version 14 is 2015.')
+    parser.add_argument(
+        '--download-workers',
+        type=_positive_int,
+        default=DOWNLOAD_WORKERS,
+        help='The number of files to download at once.')
 
     arguments = parser.parse_args()
-    fetch_all(arguments.destination, arguments.include_old_versions)
+    fetch_all(arguments.destination, arguments.include_old_versions,
+              arguments.download_workers)